@@ -1,23 +1,23 @@
 import argparse
-import copy
-import csv
 import os
 import subprocess
 import threading
 import time
 from datetime import datetime
+from functools import partial
 
 import cv2
 import numpy as np
 import tritonclient.grpc as grpcclient
 
 from yoloa.camera_api import SensorRealsense
+from yoloa.camera_pipeline import run_camera
 from yoloa.classes import COCO_CLASSES
 from yoloa.utils import (
+    ImageWriter,
     mkdir,
-    multiclass_nms,
-    postprocess,
-    preprocess,
+    list_images,
+    make_grids,
     convert_log_to_csv,
     calculate_avg_cpu_usage,
     calculate_rcs0_average,
@@ -26,6 +26,8 @@ from yoloa.visualize import vis
 
 home_dir = os.path.expanduser("~")
 current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+image_writer = ImageWriter()
+PRINT_INTERVAL = 16
 
 
 def make_parser():
@@ -69,17 +71,28 @@ def make_parser():
         default="FP32",
         choices=["FP16", "FP32"],
     )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=16,
+        help="number of requests kept in flight so OVMS can serve them in "
+        "parallel streams (see ovms_config.json)",
+    )
 
     return parser
 
 
 class PerformanceLogger:
-    def __init__(self):
+    def __init__(self, n=0):
         self.proc_gpu = None
         self.proc_cpu = None
-        self.running = False
-        self.thread = None
-        self.time_records = []
+        self.log_gpu_file = None
+        self.log_cpu_file = None
+        # rows stay NaN for requests that fail, so nanmean skips them
+        self.time_records = np.full((n, 3), np.nan, dtype=np.float32)
+        self.num_done = 0
+        self.lock = threading.Lock()
 
         self.temp_gpu_log = f"./{current_time}_gpu.txt"
         self.temp_cpu_log = f"./{current_time}_cpu.txt"
@@ -87,44 +100,26 @@ class PerformanceLogger:
         self.cpu_log = f"./log/{current_time}_cpu_log.csv"
         self.time_log = f"./log/{current_time}_time_log.csv"
 
-    def _log_metrics(self):
+    def start_logging(self):
         cmd_gpu = ["sudo", "intel_gpu_top", "-s", "100"]
         cmd_cpu = ["mpstat", "-P", "ALL", "1"]
+        self.log_gpu_file = open(self.temp_gpu_log, "w")
+        self.log_cpu_file = open(self.temp_cpu_log, "w")
         self.proc_gpu = subprocess.Popen(
-            cmd_gpu, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+            cmd_gpu, stdout=self.log_gpu_file, stderr=subprocess.DEVNULL
         )
         self.proc_cpu = subprocess.Popen(
-            cmd_cpu, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+            cmd_cpu, stdout=self.log_cpu_file, stderr=subprocess.DEVNULL
         )
 
-        log_gpu_file = open(self.temp_gpu_log, "w", newline="")
-        log_cpu_file = open(self.temp_cpu_log, "w", newline="")
-
-        while self.running:
-            gpu_output = self.proc_gpu.stdout.readline()
-            cpu_output = self.proc_cpu.stdout.readline()
-            if gpu_output:
-                log_gpu_file.write(gpu_output)
-                log_gpu_file.flush()
-            if cpu_output:
-                log_cpu_file.write(cpu_output)
-                log_cpu_file.flush()
-
-        log_gpu_file.close()
-        log_cpu_file.close()
-
-    def start_logging(self):
-        self.running = True
-        self.thread = threading.Thread(target=self._log_metrics, daemon=True)
-        self.thread.start()
-
     def stop_logging(self):
-        self.running = False
-        if self.proc_gpu:
-            self.proc_gpu.terminate()
+        for proc in [self.proc_gpu, self.proc_cpu]:
+            if proc:
+                proc.terminate()
+                proc.wait()
 
-        if self.proc_cpu:
-            self.proc_cpu.terminate()
+        self.log_gpu_file.close()
+        self.log_cpu_file.close()
 
         convert_log_to_csv(self.temp_gpu_log, self.gpu_log)
         convert_log_to_csv(self.temp_cpu_log, self.cpu_log)
@@ -132,133 +127,144 @@ class PerformanceLogger:
         os.remove(self.temp_gpu_log)
         os.remove(self.temp_cpu_log)
 
-        with open(self.time_log, "w", newline="") as file:
-            writer = csv.writer(file)
-            writer.writerow(
-                [
-                    "Preprocessing_Time(ms)",
-                    "Inference_Time(ms)",
-                    "Postprocessing_Time(ms)",
-                ]
-            )
-            writer.writerows(self.time_records)
+        np.savetxt(
+            self.time_log,
+            self.time_records,
+            fmt="%.3f",
+            delimiter=",",
+            header="Preprocessing_Time(ms),Inference_Time(ms),Postprocessing_Time(ms)",
+            comments="",
+        )
 
         print(f"Saved log file: {self.time_log}")
         print(f"Average CPU Usage: {calculate_avg_cpu_usage(self.cpu_log):.3f} %")
         print(f"Average GPU Usage: {calculate_rcs0_average(self.gpu_log):.3f} %")
 
-    def log(self, image_index, total_length, infer_time):
-        self.time_records.append([infer_time])
-        print(
-            f"\r[{image_index} / {total_length}] | Inference Time: {infer_time:.3f} ms\033[K",
-            end="",
-            flush=True,
-        )
+    def log(
+        self,
+        image_index,
+        total_length,
+        preproc_time=None,
+        infer_time=None,
+        postproc_time=None,
+    ):
+        # callbacks finish out of order, so progress counts completions
+        with self.lock:
+            self.num_done += 1
+            if infer_time is None:
+                return
+            self.time_records[image_index - 1] = (
+                preproc_time,
+                infer_time,
+                postproc_time,
+            )
+            if self.num_done % PRINT_INTERVAL and self.num_done != total_length:
+                return
+            print(
+                f"\r[{self.num_done} / {total_length}] | Inference Time: {infer_time:.3f} ms\033[K",
+                end="",
+                flush=True,
+            )
 
 
-def infer_image(client, model, input_path, output_path, input_shape, data_type):
-    d_type = {"FP16": np.float16, "FP32": np.float32}[data_type]
-    origin_img = cv2.imread(input_path).astype(np.float32)
-    img = origin_img[None, :, :, :].astype(d_type)
+def on_infer_done(
+    logger,
+    slots,
+    image_index,
+    total_length,
+    origin_img,
+    output_path,
+    preproc_time,
+    infer_s,
+    result,
+    error,
+):
+    infer_e = time.perf_counter_ns()
+    try:
+        if error is not None:
+            print(f"\nInference failed for {output_path}: {error}")
+            logger.log(image_index, total_length)
+            return
+
+        postproc_s = time.perf_counter_ns()
+        res = result.as_numpy("output_results")
+
+        if len(res) != 0:
+            class_id = res[:, 0]
+            score = res[:, 1]
+            box_coord = res[:, 2:6]
+            origin_img = vis(
+                origin_img,
+                box_coord,
+                score,
+                class_id,
+                conf=0.3,
+                class_names=COCO_CLASSES,
+            )
 
-    # preproc_s = time.time()
-    # img, ratio = preprocess(origin_img, input_shape)
-    # img = img[None, :, :, :].astype(d_type)
-    # preproc_e = time.time()
+        image_writer.write(output_path, origin_img)
+        postproc_e = time.perf_counter_ns()
 
-    inputs = grpcclient.InferInput("input_images", img.shape, datatype=data_type)
-    inputs.set_data_from_numpy(img)
-    outputs = grpcclient.InferRequestedOutput("output_results")
-
-    infer_s = time.time()
-    res = client.infer(model_name=model, inputs=[inputs], outputs=[outputs])
-    infer_e = time.time()
-
-    res = res.as_numpy("output_results")
-    res_copy = np.copy(res).astype(d_type)
-
-    # postproc_s = time.time()
-    # pred = postprocess(res_copy, input_shape)[0]
-    # boxes, scores = pred[:, :4], pred[:, 4:5] * pred[:, 5:]
-    # boxes_xyxy = np.ones_like(boxes)
-    # boxes_xyxy[:, 0] = boxes[:, 0] - boxes[:, 2] / 2.0
-    # boxes_xyxy[:, 1] = boxes[:, 1] - boxes[:, 3] / 2.0
-    # boxes_xyxy[:, 2] = boxes[:, 0] + boxes[:, 2] / 2.0
-    # boxes_xyxy[:, 3] = boxes[:, 1] + boxes[:, 3] / 2.0
-    # boxes_xyxy /= ratio
-
-    # dets = multiclass_nms(boxes_xyxy, scores, nms_thr=0.45, score_thr=0.3)
-    # if dets is not None:
-    #     final_boxes, final_scores, final_cls_inds = dets[:, :4], dets[:, 4], dets[:, 5]
-    #     origin_img = vis(
-    #         origin_img,
-    #         final_boxes,
-    #         final_scores,
-    #         final_cls_inds,
-    #         conf=0.3,
-    #         class_names=COCO_CLASSES,
-    #     )
-    # postproc_e = time.time()
-
-    if len(res_copy) != 0:
-        class_id = res_copy[:, 0]
-        score = res_copy[:, 1]
-        box_coord = res_copy[:, 2:6]
-        origin_img = vis(
-            origin_img, box_coord, score, class_id, conf=0.3, class_names=COCO_CLASSES
+        logger.log(
+            image_index,
+            total_length,
+            preproc_time,
+            (infer_e - infer_s) / 1e6,
+            (postproc_e - postproc_s) / 1e6,
         )
-
-    output_path = os.path.join(output_path, os.path.basename(input_path))
-    cv2.imwrite(output_path, origin_img)
-
-    return (infer_e - infer_s) * 1000
-
-
-def infer_camera(client, model_name, input, input_shape, data_type):
+    finally:
+        slots.release()
+
+
+def infer_image(
+    client,
+    model,
+    inputs,
+    outputs,
+    input_path,
+    output_path,
+    data_type,
+    logger,
+    slots,
+    image_index,
+    total_length,
+):
     d_type = {"FP16": np.float16, "FP32": np.float32}[data_type]
-    img, ratio = preprocess(input, input_shape)
-    img = img[None, :, :, :].astype(d_type)
+    preproc_s = time.perf_counter_ns()
+    origin_img = cv2.imread(input_path)
+    img = origin_img[None, :, :, :].astype(d_type)
+    preproc_e = time.perf_counter_ns()
 
-    inputs = grpcclient.InferInput("images", [1, 3, 416, 416], datatype=data_type)
-    outputs = grpcclient.InferRequestedOutput("output")
+    inputs.set_shape(list(img.shape))
     inputs.set_data_from_numpy(img)
+    output_path = os.path.join(output_path, os.path.basename(input_path))
 
-    res = client.infer(model_name=model_name, inputs=[inputs], outputs=[outputs])
-    res = res.as_numpy("output")
-    res_copy = np.copy(res).astype(d_type)
-
-    pred = postprocess(res_copy, input_shape)[0]
-
-    boxes, scores = pred[:, :4], pred[:, 4:5] * pred[:, 5:]
-    boxes_xyxy = np.ones_like(boxes)
-    boxes_xyxy[:, 0] = boxes[:, 0] - boxes[:, 2] / 2.0
-    boxes_xyxy[:, 1] = boxes[:, 1] - boxes[:, 3] / 2.0
-    boxes_xyxy[:, 2] = boxes[:, 0] + boxes[:, 2] / 2.0
-    boxes_xyxy[:, 3] = boxes[:, 1] + boxes[:, 3] / 2.0
-    boxes_xyxy /= ratio
-
-    dets = multiclass_nms(boxes_xyxy, scores, nms_thr=0.45, score_thr=0.3)
-    output = copy.copy(input)
-
-    if dets is not None:
-        final_boxes, final_scores, final_cls_inds = dets[:, :4], dets[:, 4], dets[:, 5]
-        output = vis(
-            input,
-            final_boxes,
-            final_scores,
-            final_cls_inds,
-            conf=0.3,
-            class_names=COCO_CLASSES,
-        )
-
-    return output
+    slots.acquire()
+    callback = partial(
+        on_infer_done,
+        logger,
+        slots,
+        image_index,
+        total_length,
+        origin_img,
+        output_path,
+        (preproc_e - preproc_s) / 1e6,
+        time.perf_counter_ns(),
+    )
+    client.async_infer(
+        model_name=model, inputs=[inputs], callback=callback, outputs=[outputs]
+    )
 
 
 def main():
     args = make_parser().parse_args()
-    client = grpcclient.InferenceServerClient(url=args.url)
+    client = grpcclient.InferenceServerClient(
+        url=args.url,
+        verbose=False,
+        keepalive_options=grpcclient.KeepAliveOptions(keepalive_time_ms=10000),
+    )
     input_shape = tuple(map(int, args.input_shape.split(",")))
-    logger = PerformanceLogger()
+    grids, expanded_strides = make_grids(input_shape)
 
     if not (
         client.is_server_live()
@@ -275,39 +281,62 @@ def main():
         output_path = f"./output/{args.folder_name}"
         mkdir(output_path)
 
-        image_files = [
-            os.path.join(args.image_dir, f)
-            for f in os.listdir(args.image_dir)
-            if f.lower().endswith(("png", "jpg", "jpeg"))
-        ]
+        image_files = list_images(args.image_dir)
+
+        inputs = grpcclient.InferInput(
+            "input_images", [1, *input_shape, 3], datatype=args.data_type
+        )
+        outputs = grpcclient.InferRequestedOutput("output_results")
 
+        logger = PerformanceLogger(len(image_files))
+        slots = threading.Semaphore(args.concurrency)
         logger.start_logging()
-        total_preproc_time, total_infer_time, total_postproc_time = 0, 0, 0
         for image_index, image_path in enumerate(image_files, start=1):
-            infer_time = infer_image(
-                client, args.model, image_path, output_path, input_shape, args.data_type
+            infer_image(
+                client,
+                args.model,
+                inputs,
+                outputs,
+                image_path,
+                output_path,
+                args.data_type,
+                logger,
+                slots,
+                image_index,
+                len(image_files),
             )
-            total_infer_time += infer_time
-            logger.log(image_index, len(image_files), infer_time)
+        for _ in range(args.concurrency):
+            slots.acquire()
 
+        image_writer.shutdown()
         logger.stop_logging()
 
-        # print(f"Avg preprocess time: {total_preproc_time / len(image_files):.3f} ms")
-        print(f"Avg inference time: {total_infer_time / len(image_files):.3f} ms")
-        # print(f"Avg postprocess time: {total_postproc_time / len(image_files):.3f} ms")
+        avg_preproc_time, avg_infer_time, avg_postproc_time = np.nanmean(
+            logger.time_records, axis=0
+        )
+        print(f"Avg preprocess time: {avg_preproc_time:.3f} ms")
+        print(f"Avg inference time: {avg_infer_time:.3f} ms")
+        print(f"Avg postprocess time: {avg_postproc_time:.3f} ms")
 
     elif args.infer_mode == "cam":
         sensor = SensorRealsense()
-        while True:
-            input = sensor.get_video_from_pipeline()[1][0]
-            output = infer_camera(
-                client, args.model, input, input_shape, args.data_type
-            )
-            cv2.namedWindow("camera viewer", cv2.WINDOW_NORMAL)
-            cv2.imshow("camera viewer", output)
-            if cv2.waitKey(1) & 0xFF in [ord("q"), 27]:
-                cv2.destroyAllWindows()
-                break
+        inputs = grpcclient.InferInput(
+            "images", [1, 3, *input_shape], datatype=args.data_type
+        )
+        outputs = grpcclient.InferRequestedOutput("output")
+        d_type = {"FP16": np.float16, "FP32": np.float32}[args.data_type]
+        input_buf = np.empty((1, 3, *input_shape), dtype=d_type)
+        run_camera(
+            sensor,
+            client,
+            args.model,
+            inputs,
+            outputs,
+            input_buf,
+            input_shape,
+            grids,
+            expanded_strides,
+        )
 
 
 if __name__ == "__main__":
@@ -1,17 +1,36 @@
 import argparse
-import copy
 import os
+import queue
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import cv2
 import numpy as np
 import tritonclient.grpc as grpcclient
+import tritonclient.utils.shared_memory as shm
+from tritonclient.utils import triton_to_np_dtype
 
 from yoloa.camera_api import SensorRealsense
+from yoloa.camera_pipeline import run_camera
 from yoloa.classes import COCO_CLASSES
-from yoloa.utils import mkdir, multiclass_nms, postprocess, preprocess
+from yoloa.utils import (
+    ImageWriter,
+    filter_scores,
+    list_images,
+    mkdir,
+    multiclass_nms_filtered,
+    apply_grids,
+    make_grids,
+    preprocess_blob,
+    xywh2xyxy,
+)
 from yoloa.visualize import vis
 
+image_writer = ImageWriter()
+PRINT_INTERVAL = 16
+
 
 def make_parser():
     parser = argparse.ArgumentParser("triton inference")
@@ -48,51 +67,157 @@ def make_parser():
         default="FP16",
         choices=["FP16", "FP32"],
     )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=16,
+        help="number of inference requests kept in flight",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        type=int,
+        default=1,
+        help="number of images per request (model max_batch_size must allow it)",
+    )
+    parser.add_argument(
+        "-shm",
+        "--shared_memory",
+        action="store_true",
+        help="pass tensors through system shared memory (server on the same host)",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        default=10.0,
+        help="seconds before an unanswered request fails and frees its slot",
+    )
 
     return parser
 
 
-def infer_image(
-    client,
-    model_name,
-    image_path,
-    output_path,
-    input_shape,
-    data_type,
-    image_id,
-    len_folder,
-):
-    d_type = {"FP16": np.float16, "FP32": np.float32}[data_type]
+class InferenceTracker:
+    def __init__(self, total_length, concurrency):
+        self.total_length = total_length
+        self.concurrency = concurrency
+        self.num_done = 0
+        self.num_infer = 0
+        self.total_infer_time = 0
+        self.slots = queue.Queue()
+        for slot in range(concurrency):
+            self.slots.put(slot)
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        return self.slots.get()
+
+    def release(self, slot, num_images, infer_time=None):
+        with self.lock:
+            prev_done, self.num_done = self.num_done, self.num_done + num_images
+            if infer_time is not None:
+                self.num_infer += 1
+                self.total_infer_time += infer_time
+                if (
+                    prev_done // PRINT_INTERVAL != self.num_done // PRINT_INTERVAL
+                    or self.num_done == self.total_length
+                ):
+                    print(
+                        f"\r{self.num_done} / {self.total_length} inference time: {infer_time:.3f} ms\033[K",
+                        end="",
+                    )
+        self.slots.put(slot)
+
+    def wait(self):
+        slots = [self.slots.get() for _ in range(self.concurrency)]
+        for slot in slots:
+            self.slots.put(slot)
+
+
+class SharedMemoryPool:
+    def __init__(self, client, num_slots, input_shape, batch_size, d_type, output):
+        self.client = client
+        self.input_byte_size = (
+            batch_size * 3 * input_shape[0] * input_shape[1] * np.dtype(d_type).itemsize
+        )
+        # sized from the model metadata; -1 marks the batch dimension
+        self.output_byte_size = (
+            batch_size
+            * int(np.prod([dim for dim in output.shape if dim > 0]))
+            * np.dtype(triton_to_np_dtype(output.datatype)).itemsize
+        )
+
+        self.input_name = f"yolox_input_{os.getpid()}"
+        self.output_name = f"yolox_output_{os.getpid()}"
+        self.input_handle = None
+        self.output_handle = None
+        self.registered = []
+        try:
+            self.input_handle = shm.create_shared_memory_region(
+                self.input_name, f"/{self.input_name}", num_slots * self.input_byte_size
+            )
+            self.output_handle = shm.create_shared_memory_region(
+                self.output_name,
+                f"/{self.output_name}",
+                num_slots * self.output_byte_size,
+            )
+            client.register_system_shared_memory(
+                self.input_name, f"/{self.input_name}", num_slots * self.input_byte_size
+            )
+            self.registered.append(self.input_name)
+            client.register_system_shared_memory(
+                self.output_name,
+                f"/{self.output_name}",
+                num_slots * self.output_byte_size,
+            )
+            self.registered.append(self.output_name)
+        except Exception:
+            self.close()
+            raise
+
+    def set_tensors(self, inputs, outputs, slot, img):
+        input_offset = slot * self.input_byte_size
+        shm.set_shared_memory_region(self.input_handle, [img], offset=input_offset)
+        inputs.set_shared_memory(self.input_name, img.nbytes, offset=input_offset)
+        outputs.set_shared_memory(
+            self.output_name,
+            self.output_byte_size,
+            offset=slot * self.output_byte_size,
+        )
+
+    def get_output(self, slot, output):
+        return shm.get_contents_as_numpy(
+            self.output_handle,
+            triton_to_np_dtype(output.datatype),
+            output.shape,
+            offset=slot * self.output_byte_size,
+        )
+
+    def close(self):
+        try:
+            for name in self.registered:
+                self.client.unregister_system_shared_memory(name)
+        finally:
+            for handle in [self.input_handle, self.output_handle]:
+                if handle is not None:
+                    shm.destroy_shared_memory_region(handle)
+
+
+def preprocess_image(image_path, output_dir, input_shape):
     origin_img = cv2.imread(image_path)
-    img, ratio = preprocess(origin_img, input_shape)
-    img = img[None, :, :, :].astype(d_type)
-
-    inputs = grpcclient.InferInput("images", img.shape, datatype=data_type)
-    inputs.set_data_from_numpy(img)
-    outputs = grpcclient.InferRequestedOutput("output")
-
-    start_time = time.time()
-    res = client.infer(model_name=model_name, inputs=[inputs], outputs=[outputs])
-    end_time = time.time()
-    print(
-        f"\r{image_id} / {len_folder} inference time: {(end_time - start_time) * 1000:.3f} ms\033[K",
-        end="",
-    )
+    blob, ratio = preprocess_blob(origin_img, input_shape)
+    output_path = os.path.join(output_dir, os.path.basename(image_path))
 
-    res = res.as_numpy("output")
-    res_copy = np.copy(res).astype(d_type)
-    pred = postprocess(res_copy, input_shape)[0]
+    return blob[0], ratio, origin_img, output_path
 
-    boxes, scores = pred[:, :4], pred[:, 4:5] * pred[:, 5:]
 
-    boxes_xyxy = np.ones_like(boxes)
-    boxes_xyxy[:, 0] = boxes[:, 0] - boxes[:, 2] / 2.0
-    boxes_xyxy[:, 1] = boxes[:, 1] - boxes[:, 3] / 2.0
-    boxes_xyxy[:, 2] = boxes[:, 0] + boxes[:, 2] / 2.0
-    boxes_xyxy[:, 3] = boxes[:, 1] + boxes[:, 3] / 2.0
-    boxes_xyxy /= ratio
+def postprocess_image(pred, ratio, origin_img, output_path, grids, expanded_strides):
+    inds, scores, cls_inds = filter_scores(pred, score_thr=0.6)
+    boxes = apply_grids(pred[inds, :4], grids[inds], expanded_strides[inds])
+    boxes_xyxy = xywh2xyxy(boxes, ratio)
 
-    dets = multiclass_nms(boxes_xyxy, scores, nms_thr=0.7, score_thr=0.6)
+    dets = multiclass_nms_filtered(boxes_xyxy, scores, cls_inds, nms_thr=0.7)
     if dets is not None:
         final_boxes, final_scores, final_cls_inds = dets[:, :4], dets[:, 4], dets[:, 5]
         origin_img = vis(
@@ -104,54 +229,97 @@ def infer_image(
             class_names=COCO_CLASSES,
         )
 
-    output_path = os.path.join(output_path, os.path.basename(image_path))
-    cv2.imwrite(output_path, origin_img)
+    image_writer.write(output_path, origin_img)
 
 
-def infer_camera(client, model_name, input, input_shape, data_type):
-    d_type = {"FP16": np.float16, "FP32": np.float32}[data_type]
-    img, ratio = preprocess(input, input_shape)
-    img = img[None, :, :, :].astype(d_type)
-
-    inputs = grpcclient.InferInput("images", img.shape, datatype=data_type)
-    inputs.set_data_from_numpy(img)
-    outputs = grpcclient.InferRequestedOutput("output")
-
-    res = client.infer(model_name=model_name, inputs=[inputs], outputs=[outputs])
-    res = res.as_numpy("output")
-    res_copy = np.copy(res).astype(d_type)
+def on_infer_done(
+    tracker,
+    shm_pool,
+    slot,
+    batch,
+    grids,
+    expanded_strides,
+    start_time,
+    result,
+    error,
+):
+    if error is not None:
+        print(f"\nInference failed for {batch[0][3]}: {error}")
+        tracker.release(slot, len(batch))
+        return
 
-    pred = postprocess(res_copy, input_shape)[0]
+    infer_time = (time.perf_counter_ns() - start_time) / 1e6
+    try:
+        if shm_pool is None:
+            res = result.as_numpy("output")
+        else:
+            res = shm_pool.get_output(slot, result.get_output("output"))
+        for i, (_, ratio, origin_img, output_path) in enumerate(batch):
+            postprocess_image(
+                res[i], ratio, origin_img, output_path, grids, expanded_strides
+            )
+    finally:
+        tracker.release(slot, len(batch), infer_time)
 
-    boxes, scores = pred[:, :4], pred[:, 4:5] * pred[:, 5:]
-    boxes_xyxy = np.ones_like(boxes)
-    boxes_xyxy[:, 0] = boxes[:, 0] - boxes[:, 2] / 2.0
-    boxes_xyxy[:, 1] = boxes[:, 1] - boxes[:, 3] / 2.0
-    boxes_xyxy[:, 2] = boxes[:, 0] + boxes[:, 2] / 2.0
-    boxes_xyxy[:, 3] = boxes[:, 1] + boxes[:, 3] / 2.0
-    boxes_xyxy /= ratio
 
-    dets = multiclass_nms(boxes_xyxy, scores, nms_thr=0.45, score_thr=0.3)
-    output = copy.copy(input)
+def produce_images(executor, preprocess_fn, image_files, prep_queue):
+    for image_path in image_files:
+        prep_queue.put(executor.submit(preprocess_fn, image_path))
+    prep_queue.put(None)
 
-    if dets is not None:
-        final_boxes, final_scores, final_cls_inds = dets[:, :4], dets[:, 4], dets[:, 5]
-        output = vis(
-            input,
-            final_boxes,
-            final_scores,
-            final_cls_inds,
-            conf=0.3,
-            class_names=COCO_CLASSES,
-        )
 
-    return output
+def infer_image(
+    client,
+    model_name,
+    inputs,
+    outputs,
+    input_buf,
+    batch,
+    grids,
+    expanded_strides,
+    tracker,
+    shm_pool=None,
+    client_timeout=None,
+):
+    img = input_buf[: len(batch)]
+    for i, preprocessed in enumerate(batch):
+        np.copyto(img[i], preprocessed[0], casting="same_kind")
+    inputs.set_shape(list(img.shape))
+
+    slot = tracker.acquire()
+    if shm_pool is None:
+        inputs.set_data_from_numpy(img)
+    else:
+        shm_pool.set_tensors(inputs, outputs, slot, img)
+
+    callback = partial(
+        on_infer_done,
+        tracker,
+        shm_pool,
+        slot,
+        batch,
+        grids,
+        expanded_strides,
+        time.perf_counter_ns(),
+    )
+    client.async_infer(
+        model_name=model_name,
+        inputs=[inputs],
+        callback=callback,
+        outputs=[outputs],
+        client_timeout=client_timeout,
+    )
 
 
 def main():
     args = make_parser().parse_args()
-    client = grpcclient.InferenceServerClient(url=args.url)
+    client = grpcclient.InferenceServerClient(
+        url=args.url,
+        verbose=False,
+        keepalive_options=grpcclient.KeepAliveOptions(keepalive_time_ms=10000),
+    )
     input_shape = tuple(map(int, args.model.split("_")[-1].split("x")))
+    grids, expanded_strides = make_grids(input_shape)
 
     if not (
         client.is_server_live()
@@ -168,39 +336,103 @@ def main():
         output_path = f"./output/{args.folder_name}"
         mkdir(output_path)
 
-        image_files = [
-            os.path.join(args.image_dir, f)
-            for f in os.listdir(args.image_dir)
-            if f.lower().endswith(("png", "jpg", "jpeg"))
-        ]
-
-        for idx, image_path in enumerate(image_files, start=1):
-            infer_image(
-                client,
-                args.model,
-                image_path,
-                output_path,
-                input_shape,
-                args.data_type,
-                idx,
-                len(image_files),
-            )
+        image_files = list_images(args.image_dir)
+
+        d_type = {"FP16": np.float16, "FP32": np.float32}[args.data_type]
+        preprocess_fn = partial(
+            preprocess_image, output_dir=output_path, input_shape=input_shape
+        )
+        prep_queue = queue.Queue(maxsize=32)
+        tracker = InferenceTracker(len(image_files), args.concurrency)
+        inputs = grpcclient.InferInput(
+            "images", [args.batch, 3, *input_shape], datatype=args.data_type
+        )
+        outputs = grpcclient.InferRequestedOutput("output")
+        input_buf = np.empty((args.batch, 3, *input_shape), dtype=d_type)
+        shm_pool = None
+        try:
+            if args.shared_memory:
+                shm_pool = SharedMemoryPool(
+                    client,
+                    args.concurrency,
+                    input_shape,
+                    args.batch,
+                    d_type,
+                    next(o for o in model_metadata.outputs if o.name == "output"),
+                )
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                producer = threading.Thread(
+                    target=produce_images,
+                    args=(executor, preprocess_fn, image_files, prep_queue),
+                    daemon=True,
+                )
+                producer.start()
+
+                batch = []
+                while (future := prep_queue.get()) is not None:
+                    batch.append(future.result())
+                    if len(batch) == args.batch:
+                        infer_image(
+                            client,
+                            args.model,
+                            inputs,
+                            outputs,
+                            input_buf,
+                            batch,
+                            grids,
+                            expanded_strides,
+                            tracker,
+                            shm_pool,
+                            args.timeout,
+                        )
+                        batch = []
+                if batch:
+                    infer_image(
+                        client,
+                        args.model,
+                        inputs,
+                        outputs,
+                        input_buf,
+                        batch,
+                        grids,
+                        expanded_strides,
+                        tracker,
+                        shm_pool,
+                        args.timeout,
+                    )
+                producer.join()
+            tracker.wait()
+        finally:
+            if shm_pool is not None:
+                shm_pool.close()
+        image_writer.shutdown()
 
         print()
         print("Inference completed for all images.")
+        if tracker.num_infer:
+            print(
+                f"Avg inference time: {tracker.total_infer_time / tracker.num_infer:.3f} ms"
+            )
 
     elif args.infer_mode == "cam":
         sensor = SensorRealsense()
-        while True:
-            input = sensor.get_video_from_pipeline()[1][0]
-            output = infer_camera(
-                client, args.model, input, input_shape, args.data_type
-            )
-            cv2.namedWindow("camera viewer", cv2.WINDOW_NORMAL)
-            cv2.imshow("camera viewer", output)
-            if cv2.waitKey(1) & 0xFF in [ord("q"), 27]:
-                cv2.destroyAllWindows()
-                break
+        inputs = grpcclient.InferInput(
+            "images", [1, 3, *input_shape], datatype=args.data_type
+        )
+        outputs = grpcclient.InferRequestedOutput("output")
+        d_type = {"FP16": np.float16, "FP32": np.float32}[args.data_type]
+        input_buf = np.empty((1, 3, *input_shape), dtype=d_type)
+        run_camera(
+            sensor,
+            client,
+            args.model,
+            inputs,
+            outputs,
+            input_buf,
+            input_shape,
+            grids,
+            expanded_strides,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+import queue
+import threading
+from functools import partial
+
+import cv2
+import numpy as np
+
+from yoloa.classes import COCO_CLASSES
+from yoloa.utils import (
+    apply_grids,
+    filter_scores,
+    multiclass_nms_filtered,
+    preprocess_blob,
+    xywh2xyxy,
+)
+from yoloa.visualize import vis
+
+WINDOW_NAME = "camera viewer"
+
+
+def put_latest(q, item):
+    """Put without blocking, dropping the oldest entry when `q` is full."""
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+
+
+def report_errors(target, errors, *args):
+    """Run `target`, handing any exception to the display loop via `errors`."""
+    try:
+        target(*args)
+    except Exception as e:
+        errors.put(e)
+
+
+def capture_frames(sensor, frame_queue, stop):
+    while not stop.is_set():
+        put_latest(frame_queue, sensor.get_video_from_pipeline()[1][0])
+
+
+def on_camera_done(
+    display_queue, slots, input, ratio, grids, expanded_strides, result, error
+):
+    try:
+        if error is not None:
+            print(f"Inference failed: {error}")
+            return
+
+        pred = result.as_numpy("output")[0]
+
+        inds, scores, cls_inds = filter_scores(pred, score_thr=0.3)
+        boxes = apply_grids(pred[inds, :4], grids[inds], expanded_strides[inds])
+        boxes_xyxy = xywh2xyxy(boxes, ratio)
+
+        dets = multiclass_nms_filtered(boxes_xyxy, scores, cls_inds, nms_thr=0.45)
+        output = input
+
+        if dets is not None:
+            final_boxes, final_scores, final_cls_inds = (
+                dets[:, :4],
+                dets[:, 4],
+                dets[:, 5],
+            )
+            output = vis(
+                input,
+                final_boxes,
+                final_scores,
+                final_cls_inds,
+                conf=0.3,
+                class_names=COCO_CLASSES,
+            )
+
+        put_latest(display_queue, output)
+    finally:
+        slots.release()
+
+
+def infer_camera(
+    client,
+    model_name,
+    inputs,
+    outputs,
+    input_buf,
+    input,
+    input_shape,
+    grids,
+    expanded_strides,
+    display_queue,
+    slots,
+):
+    img, ratio = preprocess_blob(input, input_shape)
+    np.copyto(input_buf, img, casting="same_kind")
+    inputs.set_data_from_numpy(input_buf)
+
+    slots.acquire()
+    callback = partial(
+        on_camera_done, display_queue, slots, input, ratio, grids, expanded_strides
+    )
+    client.async_infer(
+        model_name=model_name, inputs=[inputs], callback=callback, outputs=[outputs]
+    )
+
+
+def infer_frames(
+    client,
+    model_name,
+    inputs,
+    outputs,
+    input_buf,
+    input_shape,
+    grids,
+    expanded_strides,
+    frame_queue,
+    display_queue,
+    stop,
+):
+    slots = threading.Semaphore(1)
+    while not stop.is_set():
+        try:
+            frame = frame_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        infer_camera(
+            client,
+            model_name,
+            inputs,
+            outputs,
+            input_buf,
+            frame,
+            input_shape,
+            grids,
+            expanded_strides,
+            display_queue,
+            slots,
+        )
+
+
+def run_camera(
+    sensor,
+    client,
+    model_name,
+    inputs,
+    outputs,
+    input_buf,
+    input_shape,
+    grids,
+    expanded_strides,
+):
+    """Capture, inference and display on separate threads, newest frame wins.
+
+    Returns once the viewer is closed with `q` or Esc, and re-raises the first
+    exception of the capture or inference thread.
+    """
+    frame_queue = queue.Queue(maxsize=2)
+    display_queue = queue.Queue(maxsize=2)
+    errors = queue.Queue()
+    stop = threading.Event()
+
+    threads = [
+        threading.Thread(
+            target=report_errors,
+            args=(capture_frames, errors, sensor, frame_queue, stop),
+            daemon=True,
+        ),
+        threading.Thread(
+            target=report_errors,
+            args=(
+                infer_frames,
+                errors,
+                client,
+                model_name,
+                inputs,
+                outputs,
+                input_buf,
+                input_shape,
+                grids,
+                expanded_strides,
+                frame_queue,
+                display_queue,
+                stop,
+            ),
+            daemon=True,
+        ),
+    ]
+    for thread in threads:
+        thread.start()
+
+    cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_NORMAL)
+    try:
+        while True:
+            if not errors.empty():
+                raise errors.get()
+            try:
+                cv2.imshow(WINDOW_NAME, display_queue.get(timeout=0.03))
+            except queue.Empty:
+                pass
+            # keep the GUI event loop serviced even while no frame arrives
+            if cv2.waitKey(1) & 0xFF in [ord("q"), 27]:
+                break
+    finally:
+        # let the workers leave native code before the interpreter shuts down
+        stop.set()
+        for thread in threads:
+            thread.join()
+        cv2.destroyAllWindows()
@@ -2,9 +2,18 @@
 
 import os
 import csv
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
 import cv2
 import numpy as np
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 def convert_log_to_csv(txt_file, csv_file):
 
@@ -68,29 +77,36 @@ def calculate_rcs0_average(gpu_log):
     return average_rcs0
 
 
-def preprocess(img, input_size, swap=(2, 0, 1), to_byte=False):
-    if len(img.shape) == 3:
-        padded_img = np.ones((input_size[0], input_size[1], 3), dtype=np.uint8) * 114
-    else:
-        padded_img = np.ones(input_size, dtype=np.uint8) * 114
+def preprocess_blob(img, input_size):
+    """Letterbox a BGR image and pack it as a 1x3xHxW float32 blob.
+
+    blobFromImage does the HWC->CHW transpose and float conversion in a single
+    vectorized pass instead of separate transpose / astype / copy steps.
+    """
+    padded_img = np.full((input_size[0], input_size[1], 3), 114, dtype=np.uint8)
 
     r = min(input_size[0] / img.shape[0], input_size[1] / img.shape[1])
-    resized_img = cv2.resize(
-        img,
-        (int(img.shape[1] * r), int(img.shape[0] * r)),
-        interpolation=cv2.INTER_LINEAR,
-    ).astype(np.uint8)
+    resized_h, resized_w = int(img.shape[0] * r), int(img.shape[1] * r)
+    padded_img[:resized_h, :resized_w] = cv2.resize(
+        img, (resized_w, resized_h), interpolation=cv2.INTER_LINEAR
+    )
+
+    blob = cv2.dnn.blobFromImage(padded_img, 1.0, swapRB=False, crop=False)
 
-    padded_img[: int(img.shape[0] * r), : int(img.shape[1] * r)] = resized_img
+    return blob, r
 
-    if to_byte:
-        padded_img = np.ascontiguousarray(padded_img, dtype=np.uint8)
-        return padded_img, r
 
-    padded_img = padded_img.transpose(swap)
-    padded_img = np.ascontiguousarray(padded_img, dtype=np.float32)
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".PNG", ".JPG", ".JPEG")
 
-    return padded_img, r
+
+def list_images(image_dir):
+    with os.scandir(image_dir) as entries:
+        return [
+            entry.path
+            for entry in entries
+            if entry.name.endswith(IMAGE_EXTENSIONS)
+            and entry.is_file(follow_symlinks=False)
+        ]
 
 
 def mkdir(path):
@@ -98,8 +114,52 @@ def mkdir(path):
         os.makedirs(path)
 
 
+class ImageWriter:
+    """Background cv2.imwrite with at most `max_pending` images queued.
+
+    `write` blocks once the limit is reached, so decoded frames cannot pile up
+    in memory when the disk is slower than inference.
+    """
+
+    def __init__(self, max_workers=2, max_pending=8):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = threading.BoundedSemaphore(max_pending)
+
+    def write(self, path, img):
+        self.pending.acquire()
+        future = self.pool.submit(cv2.imwrite, path, img)
+        future.add_done_callback(lambda _: self.pending.release())
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+
+@lru_cache(maxsize=None)
+def _load_torchvision():
+    try:
+        import torch
+        import torchvision
+    except ImportError:
+        return None
+    return torch, torchvision
+
+
 def nms(boxes, scores, nms_thr):
-    """Single class NMS implemented in Numpy."""
+    """Single class NMS, using the torchvision C++ kernel when available."""
+    modules = _load_torchvision()
+    if modules is not None:
+        torch, torchvision = modules
+        # torchvision measures width as x2 - x1; shift the far corner so both
+        # paths share the inclusive-pixel (+1) IoU used below
+        boxes = np.array(boxes, dtype=np.float32)
+        boxes[:, 2:4] += 1
+        keep = torchvision.ops.nms(
+            torch.from_numpy(boxes),
+            torch.from_numpy(np.ascontiguousarray(scores, dtype=np.float32)),
+            nms_thr,
+        )
+        return keep.numpy()
+
     x1 = boxes[:, 0]
     y1 = boxes[:, 1]
     x2 = boxes[:, 2]
@@ -128,33 +188,77 @@ def nms(boxes, scores, nms_thr):
     return keep
 
 
-def multiclass_nms(boxes, scores, nms_thr, score_thr):
-    """Multiclass NMS implemented in Numpy"""
-    nms_method = multiclass_nms_class_agnostic
-
-    return nms_method(boxes, scores, nms_thr, score_thr)
-
-
-def multiclass_nms_class_agnostic(boxes, scores, nms_thr, score_thr):
-    """Multiclass NMS implemented in Numpy. Class-agnostic version."""
-    cls_inds = scores.argmax(1)
-    cls_scores = scores[np.arange(len(cls_inds)), cls_inds]
-
-    valid_score_mask = cls_scores > score_thr
-    if valid_score_mask.sum() == 0:
+def multiclass_nms_filtered(boxes, scores, cls_inds, nms_thr):
+    """Class-agnostic NMS on boxes already thresholded by filter_scores."""
+    if len(scores) == 0:
         return None
-    valid_scores = cls_scores[valid_score_mask]
-    valid_boxes = boxes[valid_score_mask]
-    valid_cls_inds = cls_inds[valid_score_mask]
-    keep = nms(valid_boxes, valid_scores, nms_thr)
-    if keep:
-        dets = np.concatenate(
-            [valid_boxes[keep], valid_scores[keep, None], valid_cls_inds[keep, None]], 1
-        )
+    keep = nms(boxes, scores, nms_thr)
+    dets = np.concatenate([boxes[keep], scores[keep, None], cls_inds[keep, None]], 1)
     return dets
 
 
-def postprocess(outputs, img_size, p6=False):
+if numba is not None:
+
+    @numba.njit(fastmath=True, cache=True)
+    def _best_class_score(pred, i):
+        obj = pred[i, 4]
+        best, best_ind = obj * pred[i, 5], 0
+        for c in range(6, pred.shape[1]):
+            score = obj * pred[i, c]
+            if score > best:
+                best, best_ind = score, c - 5
+        return best, best_ind
+
+    # serial on purpose: it is called concurrently from inference callback
+    # threads, which the numba threading layers do not support
+    @numba.njit(fastmath=True, cache=True)
+    def _filter_scores_kernel(pred, score_thr):
+        num_rows = pred.shape[0]
+        inds = np.empty(num_rows, dtype=np.int64)
+        scores = np.empty(num_rows, dtype=np.float32)
+        cls_inds = np.empty(num_rows, dtype=np.int64)
+        k = 0
+        for i in range(num_rows):
+            score, cls_ind = _best_class_score(pred, i)
+            if score > score_thr:
+                inds[k], scores[k], cls_inds[k] = i, score, cls_ind
+                k += 1
+        return inds[:k], scores[:k], cls_inds[:k]
+
+
+def filter_scores(pred, score_thr):
+    """Fused obj x cls scoring and thresholding of a single image prediction.
+
+    Returns the indices of the rows whose best class score exceeds `score_thr`,
+    along with that score and class, so later box math only touches survivors.
+    """
+    # numba has no float16 support, and upcasting the whole output would cost
+    # more than the scan itself
+    if numba is not None and pred.dtype == np.float32:
+        return _filter_scores_kernel(pred, score_thr)
+
+    # obj is a sigmoid output (>= 0), so max(obj * cls) == obj * max(cls) and
+    # the (N, num_classes) product never has to be materialized
+    cls_inds = pred[:, 5:].argmax(1)
+    scores = pred[:, 4] * pred[np.arange(len(cls_inds)), cls_inds + 5]
+    inds = np.nonzero(scores > score_thr)[0]
+    return inds, scores[inds], cls_inds[inds]
+
+
+def xywh2xyxy(boxes, ratio):
+    """Convert (cx, cy, w, h) boxes to (x1, y1, x2, y2) in original image scale."""
+    wh = boxes[:, 2:4] * 0.5
+    boxes_xyxy = np.empty_like(boxes)
+    np.subtract(boxes[:, :2], wh, out=boxes_xyxy[:, :2])
+    np.add(boxes[:, :2], wh, out=boxes_xyxy[:, 2:4])
+    boxes_xyxy *= 1.0 / ratio
+
+    return boxes_xyxy
+
+
+@lru_cache(maxsize=None)
+def make_grids(img_size, p6=False):
+    """Anchor-point grids and strides for a fixed input size, built once per shape."""
     grids = []
     expanded_strides = []
     strides = [8, 16, 32] if not p6 else [8, 16, 32, 64]
@@ -169,9 +273,23 @@ def postprocess(outputs, img_size, p6=False):
         shape = grid.shape[:2]
         expanded_strides.append(np.full((*shape, 1), stride))
 
-    grids = np.concatenate(grids, 1)
-    expanded_strides = np.concatenate(expanded_strides, 1)
-    outputs[..., :2] = (outputs[..., :2] + grids) * expanded_strides
-    outputs[..., 2:4] = np.exp(outputs[..., 2:4]) * expanded_strides
+    grids = np.concatenate(grids, 1)[0].astype(np.float32)
+    expanded_strides = np.concatenate(expanded_strides, 1)[0].astype(np.float32)
+    grids.flags.writeable = False
+    expanded_strides.flags.writeable = False
+
+    return grids, expanded_strides
+
+
+def apply_grids(outputs, grids, expanded_strides):
+    """Decode raw YOLOX box columns into (cx, cy, w, h) in input-image pixels.
+
+    `outputs` may hold all anchors or only selected rows, as long as `grids` and
+    `expanded_strides` are indexed the same way. It is left untouched (it may be
+    a read-only server buffer); only the four box columns are materialized.
+    """
+    boxes = np.empty((*outputs.shape[:-1], 4), dtype=np.float32)
+    boxes[..., :2] = (outputs[..., :2] + grids) * expanded_strides
+    boxes[..., 2:4] = np.exp(outputs[..., 2:4], dtype=np.float32) * expanded_strides
 
-    return outputs
+    return boxes